@@ -1,6 +1,33 @@
 from abc import ABC, abstractmethod
 import numpy as np
 import warnings
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, without it the corrections run as plain python
+    def njit(**kwargs):
+        return lambda func: func
+
+_SALTIKOV_COEFF = np.array([1.6461, -0.4561, -0.1162, -0.0415, -0.0173,
+                            -0.0079, -0.0038, -0.0018, -0.0010, -0.0003,
+                            -0.0002, -0.0002])
+
+class _BinRow():
+    ''' 
+    Per-bin array stored as one row of the owner's packed 2D array, so that
+    all per-bin quantities of an object share a single contiguous block.
+    Assigning to the attribute copies the values into that row.
+    '''
+    def __init__(self, row):
+        self.row = row
+        
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj._per_bin[self.row]
+    
+    def __set__(self, obj, value):
+        obj._per_bin[self.row] = value
 
 class VSD():
     '''
@@ -9,40 +36,53 @@ class VSD():
     Parameters
     ----------
     vesicles : array, sizes of individual vesicles
+    bins : Bins, optional, already binned vesicles to reuse
     '''
+    nv = _BinRow(0)
+    n = _BinRow(1)
+    lnn = _BinRow(2)
     
-    def __init__(self, vesicles):
+    def __init__(self, vesicles, bins=None):
         self.vesicles = vesicles
-        self.bins = Bins(self.vesicles, self.params)
-        self.bins.bin_data()
+        if bins is None:
+            self.bins = Bins(self.vesicles, self.params)
+            self.bins.bin_data()
+        else:
+            self.bins = bins
+        self._per_bin = np.zeros((3, self.params['nbins']))
         
     def compute_nv(self, voi_area):
-        self.nv = np.zeros_like(self.bin_centers)
-        for i in np.arange(self.params['nbins']):
-            self.nv[i] = len(self.ind[self.ind == i]) / voi_area
+        self.nv = self.bins.counts / voi_area
         
     def to_lnn(self):
         divisor = self.bins.bin_widths * 1e-3 * self.bins.norm
         if self.params['length_type'] != 'diameter':
             divisor *= 2
-        self.n = np.divide(self.nv * 1e9, divisor)
-        self.lnn = np.log(self.n)
+        # Write straight into the packed rows to avoid temporaries
+        n = self.n
+        np.multiply(self.nv, 1e9, out=n)
+        n /= divisor
+        np.log(n, out=self.lnn)
         
     def plot_data(self, ax, yvar, color, marker):
-        xdata = np.multiply(self.bins.bin_centers,self.bins.norm)
-        if self.bins.params['length_type'] != 'diameter':
-            xdata *= 2
-        ax.plot(xdata, getattr(self,yvar),
+        ax.plot(self.bins.center_diameters, getattr(self,yvar),
                 marker=marker,color=color,linestyle='None')
 
 class VSDCorrection(ABC, VSD):
-    ''' Base class for vesicles size distribution correction methods '''
-    def __init__(self, vesicles, roi_area):
-        super().__init__(vesicles)
+    ''' 
+    Base class for vesicles size distribution correction methods 
+    
+    Subclasses define bin_params, the binning parameters that are fixed 
+    for the method. Bins passed in with the same bin_params, length_type, 
+    nbins, and roi_area can be shared between corrections, skipping the 
+    binning and per-bin statistics.
+    '''
+    def __init__(self, vesicles, roi_area, bins=None):
+        super().__init__(vesicles, bins)
         self.roi_area = roi_area
-        self.nv = np.zeros_like(self.bins.bin_centers)
-        self.bins.compute_na(roi_area)
-        self.bins.compute_hbar()
+        if bins is None:
+            self.bins.compute_na(roi_area)
+            self.bins.compute_hbar()
 
     @abstractmethod
     def to_nv(self):
@@ -61,10 +101,15 @@ class Bins():
         - 'normalized' : Bool , determines whether normalized sizes are used
         - 'bin_type' : str , determines between 'linear' or 'geometric' bins
         - 'nbins' : int , number of bins to create
+        - 'length_type' : str , whether sizes are 'radius' or 'diameter'
         - 'hbar_method' : str , method for determine characteristic size 
                                 within each ('bin_center', 'median', 'mean')
                             
     '''
+    bin_centers = _BinRow(0)
+    bin_widths = _BinRow(1)
+    na = _BinRow(2)
+    hbar = _BinRow(3)
     
     def __init__(self, vesicles, params):
         self.params = params
@@ -78,11 +123,29 @@ class Bins():
         self._create_bins()
         
     def bin_data(self):
-        self.ind = np.digitize(self.vesicles, self.bin_edges, right=True) - 1
+        ''' 
+        Assign vesicles to bins, equivalent to 
+        np.digitize(vesicles, bin_edges, right=True) - 1 but computed from 
+        the bin spacing rather than by searching the bin edges
+        '''
+        vesicles = np.asarray(self.vesicles)
+        nbins = self.params['nbins']
+        if self.params['bin_method'] == 'linear':
+            step = self.bin_edges[0] - self.bin_edges[1]
+            position = (self.bin_edges[0] - vesicles) / step
+        elif self.params['bin_method'] == 'geometric':
+            position = -10 * np.log10(vesicles / self.bin_edges[0])
+        self.ind = np.clip(np.floor(position), 0, nbins).astype(np.intp)
+        # Correct vesicles placed on the wrong side of an edge by rounding
+        self.ind -= vesicles > self.bin_edges[self.ind]
+        self.ind += (self.ind < nbins) & \
+            (vesicles <= self.bin_edges[np.minimum(self.ind + 1, nbins)])
         self.__check_inrange()
+        self._grouped_stats()
         
     def _create_bins(self):
         ''' Create either linear or geometric bins '''
+        self._per_bin = np.zeros((4, self.params['nbins']))
         if self.params['bin_method'] == 'linear':
             self.bin_edges = np.linspace(np.max(self.vesicles) * 1.0000001,
                                     np.min(self.vesicles) * 0.9999999,
@@ -90,8 +153,13 @@ class Bins():
         elif self.params['bin_method'] == 'geometric':
             self.bin_edges = np.max(self.vesicles) \
                 * 10 ** (-0.1 * np.arange(self.params['nbins'] + 1))
-        self.bin_widths = abs(self.bin_edges[1:]-self.bin_edges[:-1])
-        self.bin_centers = self.bin_edges[:-1] - self.bin_widths / 2
+        # Edges are in descending order for both bin types
+        self.bin_widths = self.bin_edges[:-1] - self.bin_edges[1:]
+        self.bin_centers = self.bin_edges[:-1] - 0.5 * self.bin_widths
+        # Bin centers as unnormalized diameters, for plotting
+        self.center_diameters = self.bin_centers * self.norm
+        if self.params['length_type'] != 'diameter':
+            self.center_diameters *= 2
     
     def __check_inrange(self):
         if np.max(self.ind) >= self.params['nbins']:
@@ -100,28 +168,62 @@ class Bins():
                     len(self.ind[self.ind >= self.params['nbins']])),
                 RuntimeWarning, stacklevel=2)
             
+    def _grouped_stats(self):
+        ''' 
+        Per-bin vesicle counts and sums, computed once after binning and 
+        shared by compute_na, compute_hbar, and VSD.compute_nv
+        '''
+        nbins = self.params['nbins']
+        in_range = (self.ind >= 0) & (self.ind < nbins)
+        self._ind_in_range = self.ind[in_range]
+        self._vesicles_in_range = np.asarray(self.vesicles)[in_range]
+        self.counts = np.bincount(self._ind_in_range, minlength=nbins)
+        self._sums = np.bincount(self._ind_in_range, 
+                                 weights=self._vesicles_in_range,
+                                 minlength=nbins)
+        self._sorted_vesicles = None
+        
+    def _sorted_by_bin(self):
+        ''' In range vesicles sorted by bin, then by size within each bin '''
+        if self._sorted_vesicles is None:
+            order = np.lexsort((self._vesicles_in_range, self._ind_in_range))
+            self._sorted_vesicles = self._vesicles_in_range[order]
+        return self._sorted_vesicles
+            
     def compute_na(self, roi_area):
-        self.na = np.zeros_like(self.bin_centers)
-        for i in np.arange(self.params['nbins']):
-            self.na[i] = len(self.ind[self.ind == i]) / roi_area
+        self.na = self.counts / roi_area
             
     def compute_hbar(self):
         ''' Determine the characteristic vesicle size for each bin '''
-        self.hbar = np.zeros_like(self.bin_centers)
         # Add code to check for accepted method
         if self.params['hbar_method'] == 'bin_center':
             self.hbar = self.bin_centers
+            return
+        counts = self.counts
+        if self.params['hbar_method'] == 'mean':
+            self.hbar = self._sums / np.maximum(counts, 1)
+        elif self.params['hbar_method'] == 'median':
+            # Bins are sorted internally, so read off the middle vesicle(s)
+            sorted_vesicles = self._sorted_by_bin()
+            starts = np.cumsum(counts) - counts
+            filled = counts > 0
+            lower = (starts + (counts - 1) // 2)[filled]
+            upper = (starts + counts // 2)[filled]
+            self.hbar = np.zeros_like(self.bin_centers)
+            self.hbar[filled] = (sorted_vesicles[lower] + 
+                                 sorted_vesicles[upper]) / 2
         else:
-            for i in np.arange(self.params['nbins']):
-                in_vesicles = self.vesicles[self.ind == i]
-                if not in_vesicles.any():
-                    warnings.warn(
-                        'Bin {} does not contain vesicles, using bin center'. \
-                            format(i), RuntimeWarning, stacklevel=2)
-                    self.hbar[i] = self.bin_centers[i]
-                else:
-                    self.hbar[i] = getattr(np, self.params['hbar_method'])(
-                        in_vesicles)
+            groups = np.split(self._sorted_by_bin(), np.cumsum(counts)[:-1])
+            hbar_func = getattr(np, self.params['hbar_method'])
+            self.hbar = np.array([hbar_func(group) if len(group) else 0.
+                                  for group in groups])
+        empty = counts == 0
+        if empty.any():
+            warnings.warn(
+                'Bins {} do not contain vesicles, using bin center'. \
+                    format(np.flatnonzero(empty).tolist()),
+                RuntimeWarning, stacklevel=2)
+            self.hbar[empty] = self.bin_centers[empty]
     
     
 class ChengLemlich(VSDCorrection):
@@ -134,17 +236,19 @@ class ChengLemlich(VSDCorrection):
     roi_area : float, area of the planar section of the sample analyzed
     length_type : str, 'radius' or 'diameter'
     nbins : int, number of bins to use in the VSD correction
+    bins : Bins, optional, bins from a correction with the same bin_params
     
     '''
+    bin_params = {'bin_method': 'linear', 'hbar_method': 'mean',
+                   'normalized': False}
     
-    def __init__(self, vesicles, roi_area, length_type, nbins):
+    def __init__(self, vesicles, roi_area, length_type, nbins, bins=None):
         if length_type != 'radius':
             warnings.warn('Input length for C&L correction should be radius',
                           RuntimeWarning, stacklevel=2)
-        self.params = {'bin_method': 'linear', 'hbar_method': 'mean',
-                       'length_type': length_type, 'nbins': nbins,
-                       'normalized': False}
-        super().__init__(vesicles, roi_area)
+        self.params = {**self.bin_params, 'length_type': length_type,
+                       'nbins': nbins}
+        super().__init__(vesicles, roi_area, bins)
         self.to_nv()
         self.to_lnn()
     
@@ -163,17 +267,19 @@ class SahagianProussevitch(VSDCorrection):
     roi_area : float, area of the planar section of the sample analyzed
     length_type : str, 'radius' or 'diameter'
     nbins : int, number of bins to use in the VSD correction
+    bins : Bins, optional, bins from a correction with the same bin_params
     
     '''
+    bin_params = {'bin_method': 'geometric', 'hbar_method': 'bin_center',
+                   'normalized': False}
     
-    def __init__(self, vesicles, roi_area, length_type, nbins):
+    def __init__(self, vesicles, roi_area, length_type, nbins, bins=None):
         if length_type != 'diameter':
             warnings.warn('Input length for S&P correction should be diameter',
                           RuntimeWarning, stacklevel=2)
-        self.params = {'bin_method': 'geometric', 'hbar_method': 'bin_center',
-                       'length_type': length_type, 'nbins': nbins,
-                       'normalized': False}
-        super().__init__(vesicles, roi_area)
+        self.params = {**self.bin_params, 'length_type': length_type,
+                       'nbins': nbins}
+        super().__init__(vesicles, roi_area, bins)
         self.intersection_probabilities()
         self.to_nv()
         self.to_lnn()
@@ -181,23 +287,13 @@ class SahagianProussevitch(VSDCorrection):
         
     def intersection_probabilities(self):
         ''' Intersection probabilities valid for geometric bins only '''
-        self.inter_prob = np.zeros_like(self.bins.bin_centers)
-        for i in np.arange(self.params['nbins']):
-            self.inter_prob[i] = (1 / self.bins.bin_edges[0]) * (
-                np.sqrt(self.bins.bin_edges[0] ** 2 - 
-                        self.bins.bin_edges[i+1] ** 2) - 
-                np.sqrt(self.bins.bin_edges[0] ** 2 - 
-                        self.bins.bin_edges[i] ** 2))
+        max_edge = self.bins.bin_edges[0]
+        chords = np.sqrt(max_edge ** 2 - self.bins.bin_edges ** 2)
+        self.inter_prob = np.diff(chords) / max_edge
             
     def to_nv(self):
-        for i in np.arange(self.params['nbins']):
-            previous = 0
-            for j in np.arange(i):
-                previous = previous + (self.inter_prob[j+1] * 
-                                       self.bins.hbar[j+1] * 
-                                       self.nv[i-j-1])
-            self.nv[i] = (1 / (self.inter_prob[0] * self.bins.hbar[i])) \
-                         * (self.bins.na[i] - previous)
+        self.nv = _sp_to_nv(self.bins.na, self.bins.hbar, self.inter_prob,
+                            self.params['nbins'])
 
 
 class Saltikov(VSDCorrection):
@@ -210,25 +306,37 @@ class Saltikov(VSDCorrection):
     roi_area : float, area of the planar section of the sample analyzed
     length_type : str, 'radius' or 'diameter'
     nbins : int, number of bins to use in the VSD correction
+    bins : Bins, optional, bins from a correction with the same bin_params
     
     '''
+    bin_params = {'bin_method': 'linear', 'hbar_method': 'mean',
+                   'normalized': False}
     
-    def __init__(self, vesicles, roi_area, length_type, nbins):
+    def __init__(self, vesicles, roi_area, length_type, nbins, bins=None):
         if length_type != 'diameter':
             warnings.warn('Input length for S correction should be diameter',
                           RuntimeWarning, stacklevel=2)
-        self.params = {'bin_method': 'linear', 'hbar_method': 'mean',
-                       'length_type': length_type, 'nbins': nbins,
-                       'normalized': False}
-        super().__init__(vesicles, roi_area)
+        self.params = {**self.bin_params, 'length_type': length_type,
+                       'nbins': nbins}
+        super().__init__(vesicles, roi_area, bins)
         self.to_nv()
         self.to_lnn()
 
     def to_nv(self):
-        coeff = [1.6461, -0.4561, -0.1162, -0.0415, -0.0173, -0.0079, 
-                -0.0038, -0.0018, -0.0010, -0.0003, -0.0002, -0.0002]
-        for i in np.arange(self.params['nbins']):
-            na_sum = coeff[0] * self.bins.na[i]
-            for k in np.arange(1,i+1):
-                na_sum = na_sum + coeff[k] * self.bins.na[i-k]
-            self.nv[i] = 1 / self.bins.hbar[i] * na_sum
+        # nv[i] = sum(coeff[k] * na[i-k]) / hbar[i], a causal convolution
+        nbins = self.params['nbins']
+        self.nv = np.convolve(self.bins.na, _SALTIKOV_COEFF[:nbins])[:nbins] \
+            / self.bins.hbar
+
+
+@njit(cache=True)
+def _sp_to_nv(na, hbar, inter_prob, nbins):
+    ''' Sahagian and Proussevitch (1998) correction, from largest bin down '''
+    # Weights of the larger bins do not depend on i, so compute them once
+    weights = inter_prob[1:] * hbar[1:]
+    scale = 1 / (inter_prob[0] * hbar)
+    nv = np.zeros(nbins)
+    for i in range(nbins):
+        previous = np.sum(weights[:i] * nv[:i][::-1])
+        nv[i] = scale[i] * (na[i] - previous)
+    return nv
@@ -1,7 +1,11 @@
 import pandas as pd
 import numpy as np
 import warnings
-from importlib import import_module
+from concurrent.futures import ThreadPoolExecutor
+import stereology
+
+_VSD_METHODS = {method: getattr(stereology, method) for method in 
+                ['ChengLemlich', 'SahagianProussevitch', 'Saltikov']}
 
 
 class Sample():
@@ -12,19 +16,74 @@ class Sample():
         self.image_num = 0; self.image_index = {}; self.images = []
         self.scan_num = 0; self.scan_index = {}; self.scans = []
         self.roi_area = 0
-        self.image_data = pd.DataFrame()
+        self._image_frames = []; self._image_data = None
+        self._bins_cache = {}
+    
+    @property
+    def image_data(self):
+        ''' Cumulative image data, concatenated once when first requested '''
+        if self._image_data is None:
+            if self._image_frames:
+                self._image_data = pd.concat(self._image_frames)
+            else:
+                self._image_data = pd.DataFrame()
+        return self._image_data
     
     def add_image(self, image_id, file, meta_file, units, min_diameter):
         ''' Add image data (ImageJ output and metadata) for the sample '''
-        self.images.append(Image(file, meta_file, units, min_diameter))
-        self.image_data = pd.concat([self.image_data,
-                                     self.images[self.image_num].image_data])
-        self.roi_area += self.images[self.image_num].roi_area
+        self._store_image(image_id, Image(file, meta_file, units, min_diameter))
+        
+    def add_images(self, images, max_workers=None):
+        ''' 
+        Add several images for the sample, loading the files in parallel
+        
+        Parameters
+        ----------
+        images : list of tuples, (image_id, file, meta_file, units, 
+                                  min_diameter) for each image, as passed to
+                                  add_image
+        max_workers : int, number of loader threads (ThreadPoolExecutor 
+                           default if None)
+        
+        '''
+        images = list(images)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            loaded = list(executor.map(lambda spec: Image(*spec[1:]), images))
+        for spec, image in zip(images, loaded):
+            self._store_image(spec[0], image)
+            
+    def _store_image(self, image_id, image):
+        self.images.append(image)
+        self._image_frames.append(image.image_data)
+        self._image_data = None
+        self._bins_cache = {}
+        self.roi_area += image.roi_area
         self.image_index.update({image_id: self.image_num})
         self.image_num += 1
      
     def add_scan(self, scan_id, i3d_file, ctan_file, min_diameter):
-        self.scans.append(Scan(i3d_file, ctan_file, min_diameter))
+        self._store_scan(scan_id, Scan(i3d_file, ctan_file, min_diameter))
+        
+    def add_scans(self, scans, max_workers=None):
+        ''' 
+        Add several scans for the sample, loading the files in parallel
+        
+        Parameters
+        ----------
+        scans : list of tuples, (scan_id, i3d_file, ctan_file, min_diameter)
+                                for each scan, as passed to add_scan
+        max_workers : int, number of loader threads (ThreadPoolExecutor 
+                           default if None)
+        
+        '''
+        scans = list(scans)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            loaded = list(executor.map(lambda spec: Scan(*spec[1:]), scans))
+        for spec, scan in zip(scans, loaded):
+            self._store_scan(spec[0], scan)
+            
+    def _store_scan(self, scan_id, scan):
+        self.scans.append(scan)
         self.scan_index.update({scan_id: self.scan_num})
         self.scan_num += 1
         
@@ -40,13 +99,18 @@ class Sample():
         nbins: int, number of bins for the analysis
         
         '''
-        stereology = import_module('stereology')
+        correction = _VSD_METHODS[method]
+        # Corrections with the same binning share one set of bins
+        bins_key = (length_type, nbins, 
+                    tuple(sorted(correction.bin_params.items())))
         self.vsd_index.update({key: self.vsd_num})
-        self.vsd.append(getattr(stereology, method)(vesicles=
-                                            self.image_data[length_type],
-                                            roi_area=self.roi_area,
-                                            length_type=length_type,
-                                            nbins=nbins))
+        self.vsd.append(correction(vesicles=
+                                   self.image_data[length_type].to_numpy(),
+                                   roi_area=self.roi_area,
+                                   length_type=length_type,
+                                   nbins=nbins,
+                                   bins=self._bins_cache.get(bins_key)))
+        self._bins_cache[bins_key] = self.vsd[-1].bins
         self.vsd_num += 1
 
 class Scan():
@@ -90,7 +154,11 @@ class Scan():
                                      skiprows = start_ind,
                                      header=None,
                                      nrows = self.params['n_slices'],
-                                     usecols=[0, 1, 2, 3, 4, 5, 9, 10])
+                                     usecols=[0, 1, 2, 3, 4, 5, 9, 10],
+                                     dtype={0: str, 1: float, 2: float, 
+                                            3: float, 4: float, 5: float, 
+                                            9: float, 10: float},
+                                     encoding='latin1')
         self.ctan_data.columns = \
             ['image_number','z_position','num_objects','total_ROI_area',
              'object_area','percent_object_area','mean_vesicle_area',
@@ -99,7 +167,8 @@ class Scan():
     def load_i3d_data(self):
         self.i3d_data = pd.read_csv(self.i3d_file,
                                     skiprows=[0,1,2,4,5],
-                                    usecols=[1,2,7,8,9,11,14])
+                                    usecols=[1,2,7,8,9,11,14],
+                                    dtype=float)
         self.i3d_data.columns = ['volume','surface','x','y','z','diameter',
                                  'sphericity']
         self.i3d_data['radius'] = self.i3d_data['diameter']/2
@@ -122,6 +191,9 @@ class Image():
     units : str, units for metadata (usually micrometers)
     min_diameter: float or int, minimum vesicle size to include in analysis
     '''
+    columns = ['area', 'x', 'y', 'perimeter', 'bx', 'by', 'width', 'height',
+               'major_axis', 'minor_axis', 'angle', 'xstart', 'ystart',
+               'radius', 'diameter']
     
     def __init__(self, file, meta_file, units, min_diameter):
         self.file = file
@@ -133,58 +205,60 @@ class Image():
         self.vsd = []
         self.vsd_index = {}
         self.vsd_num = 0
+        self._bins_cache = {}
         self.load_data()
         self.load_metadata()
-        self.scale_data()
         self.threshold_data()
+        self.scale_data()
         
     def load_data(self):
         ''' Load results from ImageJ analyses of vesicles '''
-        self.image_data = pd.read_csv(self.file, header=None)
-        self.image_data.columns = ['area', 
-                                   'x',
-                                   'y',
-                                   'perimeter',
-                                   'bx',
-                                   'by',
-                                   'width',
-                                   'height',
-                                   'major_axis',
-                                   'minor_axis',
-                                   'angle',
-                                   'xstart',
-                                   'ystart']
-        self.image_data['radius'] = np.sqrt(self.image_data['area'] / np.pi)
-        self.image_data['diameter'] = np.multiply(self.image_data['radius'],2)
+        measurements = pd.read_csv(self.file, header=None,
+                                   dtype=float).to_numpy()
+        # One contiguous row per measurement, plus radius and diameter
+        self._data = np.empty((len(self.columns), len(measurements)))
+        self._data[:measurements.shape[1]] = measurements.T
+        radius = self._data[self.columns.index('radius')]
+        np.sqrt(self._data[self.columns.index('area')] / np.pi, out=radius)
+        np.multiply(radius, 2, out=self._data[self.columns.index('diameter')])
+        self._rows = np.arange(len(measurements))
+        
+    @property
+    def image_data(self):
+        ''' Image data as a DataFrame, without copying the underlying array '''
+        return pd.DataFrame(self._data.T, index=self._rows, 
+                            columns=self.columns, copy=False)
         
     def scale_data(self):
         ''' ImageJ results are in pixels, apply unit conversion from metadata'''
         if not self.params['scaled']:
-            self.image_data['area'] = self.image_data['area'] \
-                * self.pixel_size ** 2
-            for measurement in ['x','y','perimeter','bx','by','width','height',
-                                'major_axis','minor_axis','xstart','ystart',
-                                'radius','diameter']:
-                self.image_data[measurement] = self.image_data[measurement] * \
-                    self.pixel_size
+            self._data[self.columns.index('area')] *= self.pixel_size ** 2
+            lengths = [self.columns.index(measurement) for measurement in 
+                       ['x','y','perimeter','bx','by','width','height',
+                        'major_axis','minor_axis','xstart','ystart',
+                        'radius','diameter']]
+            self._data[lengths] *= self.pixel_size
             self.params['scaled'] = True
         else:
-            warnings.warm('Image data has already been scaled, scale not applied',
+            warnings.warn('Image data has already been scaled, scale not applied',
                           RuntimeWarning, stacklevel=2)
             
     def load_metadata(self):
         ''' Load metadata (roi size and image pixel resolution) '''
         with open(self.meta_file) as mf:
             mf.readline()
-            self.pixel_size = np.array(
-                mf.readline().strip().split(',')[1]).astype(float)
-            self.roi_area = np.array(
-                mf.readline().strip().split(',')[1]).astype(float)
+            self.pixel_size = float(mf.readline().split(',')[1])
+            self.roi_area = float(mf.readline().split(',')[1])
         
     def threshold_data(self):
         ''' Threshold based on the minimum allowed vesicle size '''
-        self.image_data = self.image_data[self.image_data['diameter'] \
-                          > self.params['min_diameter']]
+        min_diameter = self.params['min_diameter']
+        if not self.params['scaled']:
+            # Compare in pixels so discarded vesicles are never scaled
+            min_diameter = min_diameter / self.pixel_size
+        keep = self._data[self.columns.index('diameter')] > min_diameter
+        self._data = np.compress(keep, self._data, axis=1)
+        self._rows = self._rows[keep]
         self.params['thresholded'] = True
             
             
@@ -200,11 +274,16 @@ class Image():
         nbins: int, number of bins for the analysis
         
         '''
-        stereology = import_module('stereology')
+        correction = _VSD_METHODS[method]
+        # Corrections with the same binning share one set of bins
+        bins_key = (length_type, nbins, 
+                    tuple(sorted(correction.bin_params.items())))
         self.vsd_index.update({key: self.vsd_num})
-        self.vsd.append(getattr(stereology, method)(vesicles=
-                                            self.image_data[length_type],
-                                            roi_area=self.roi_area,
-                                            length_type=length_type,
-                                            nbins=nbins))
+        self.vsd.append(correction(vesicles=
+                                   self.image_data[length_type].to_numpy(),
+                                   roi_area=self.roi_area,
+                                   length_type=length_type,
+                                   nbins=nbins,
+                                   bins=self._bins_cache.get(bins_key)))
+        self._bins_cache[bins_key] = self.vsd[-1].bins
         self.vsd_num += 1